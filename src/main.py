@@ -2,6 +2,9 @@
 
 import argparse
 import os
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import TensorDataset
 
 from trainer.factories import loss_fn_factory
@@ -38,6 +41,19 @@ assert(args.train or args.predict)
 
 # Initial setup
 config = read_config(args.config_path)
+
+# Inputs are always padded to max_length, so the fastest convolution
+# algorithms only need to be found once
+torch.backends.cudnn.benchmark = True
+
+# Use one GPU per process when launched with torchrun
+local_rank = os.environ.get("LOCAL_RANK")
+if local_rank is not None:
+    local_rank = int(local_rank)
+    dist.init_process_group(backend="nccl")
+    torch.cuda.set_device(local_rank)
+    config["trainer"]["device"] = "cuda:{}".format(local_rank)
+
 features, labels, model = setup(config["model"])
 model = move_to_device(config["trainer"]["device"], model) # model needs to be on correct device BEFORE optimizer is initialized
 datasets = {
@@ -53,6 +69,10 @@ trainer = MulticlassClassifierTrainer(config["trainer"])
 if args.load:
     model, optimizer = abcnn_model_loader(args.load, model, optimizer)
 
+# Synchronize gradients across processes during distributed training
+if local_rank is not None:
+    model = DistributedDataParallel(model, device_ids=[local_rank])
+
 # Train the model
 if args.train:
     trainset = datasets[args.trainset]
@@ -63,3 +83,7 @@ if args.train:
 if args.predict:
     testset = datasets[args.testset]
     trainer.predict(testset)
+
+# Clean up the distributed process group
+if local_rank is not None:
+    dist.destroy_process_group()
@@ -64,7 +64,6 @@ class ABCNN1Attention(nn.Module):
         """
         # Get attention matrix and its transpose
         A = compute_attention_matrix(x1, x2, self.match_score)
-        A = A.cuda() if self.W1.is_cuda else A
         A_t = A.permute(0, 1, 3, 2)
 
         # Compute attention feature maps
@@ -51,18 +51,14 @@ class ABCNN2Attention(nn.Module):
         # Initialize outputs for attention layer
         batch_size = x1.shape[0]
         output_size = x1.shape[3]
-        w1 = torch.zeros((batch_size, 1, self.max_length, output_size))
-        w2 = torch.zeros((batch_size, 1, self.max_length, output_size))
-        w1 = w1.cuda() if x1.is_cuda else w1
-        w2 = w2.cuda() if x2.is_cuda else w2
+        w1 = torch.zeros((batch_size, 1, self.max_length, output_size), device=x1.device)
+        w2 = torch.zeros((batch_size, 1, self.max_length, output_size), device=x2.device)
 
         # Compute the outputs
         for j in range(self.max_length):
             for k in range(j, j + self.width):    
                 row_sum = torch.sum(A[:, :, :, k], dim=2, keepdim=True)
                 col_sum = torch.sum(A[:, :, k, :], dim=2, keepdim=True)
-                row_sum = row_sum.cuda() if x1.is_cuda else row_sum
-                col_sum = col_sum.cuda() if x2.is_cuda else col_sum
                 w1[:, :, j, :] += row_sum * x1[:, :, k, :]
                 w2[:, :, j, :] += col_sum * x2[:, :, k, :]
         return w1, w2
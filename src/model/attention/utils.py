@@ -25,7 +25,7 @@ def compute_attention_matrix(x1, x2, match_score):
     """
     batch_size = x1.shape[0]
     max_length = x1.shape[2]
-    A = torch.empty((batch_size, 1, max_length, max_length), dtype=torch.float)
+    A = torch.empty((batch_size, 1, max_length, max_length), dtype=torch.float, device=x1.device)
     for i in range(max_length):
         for j in range(max_length):
             b1 = x1[:, :, i, :]
@@ -21,13 +21,15 @@ class ABCNN1Block(nn.Module):
                     The Convolutional layer for the ABCNN-1 Block.
                 pool: WidthAP Module
                     The w-ap Average Pooling layer for the ABCNN-1 Block.
+                dropout_rate: float
+                    The dropout probability applied to the w-ap outputs.
         """
         super().__init__()
         self.conv = conv
         self.attn = attn
         self.pool = pool
         self.ap = AllAP()
-        self.dropout = nn.Dropout2d(p=dropout_rate)
+        self.dropout = nn.Dropout(p=dropout_rate)
     
     def forward(self, x1, x2):
         """ Computes the forward pass over the ABCNN-1 Block.
@@ -45,8 +47,11 @@ class ABCNN1Block(nn.Module):
                     optionally passed to the output layer.
         """
         o1, o2 = self.attn(x1, x2) # shapes (batch_size, 2, max_length, input_size)
-        c1, c2 = self.conv(o1), self.conv(o2) # shapes (batch_size, 1, max_length + width - 1, output_size)
-        w1, w2 = self.pool(c1), self.pool(c2) # shapes (batch_size, 1, max_length, output_size)
-        w1, w2 = self.dropout(w1), self.dropout(w2)
-        a1, a2 = self.ap(c1), self.ap(c2) # shapes (batch_size, output_size)
+
+        # Process both sequences as a single batch to halve the kernel launches
+        c = self.conv(torch.cat([o1, o2], dim=0)) # shape (2 * batch_size, 1, max_length + width - 1, output_size)
+        w = self.dropout(self.pool(c)) # shape (2 * batch_size, 1, max_length, output_size)
+        a = self.ap(c) # shape (2 * batch_size, output_size)
+        w1, w2 = w.chunk(2, dim=0)
+        a1, a2 = a.chunk(2, dim=0)
         return w1, w2, a1, a2
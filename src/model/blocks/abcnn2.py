@@ -16,7 +16,7 @@ class ABCNN2Block(nn.Module):
         self.conv = conv
         self.attn = attn
         self.ap = AllAP()
-        self.dropout = nn.Dropout2d(p=dropout_rate)
+        self.dropout = nn.Dropout(p=dropout_rate)
 
     def forward(self, x1, x2):
         """ Computes the forward pass over the ABCNN-1 Block.
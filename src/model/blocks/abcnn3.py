@@ -31,7 +31,7 @@ class ABCNN3Block(nn.Module):
         self.conv = conv
         self.attn2 = attn2
         self.ap = AllAP()
-        self.dropout = nn.Dropout2d(p=dropout_rate)
+        self.dropout = nn.Dropout(p=dropout_rate)
 
     def forward(self, x1, x2):
         """ Computes the forward pass over the ABCNN-3 Block.
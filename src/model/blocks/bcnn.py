@@ -27,7 +27,7 @@ class BCNNBlock(nn.Module):
         self.conv = conv
         self.pool = pool
         self.ap = AllAP()
-        self.dropout = nn.Dropout2d(p=dropout_rate)
+        self.dropout = nn.Dropout(p=dropout_rate)
 
     def forward(self, x1, x2):
         """ Computes the forward pass over the BCNN Block.
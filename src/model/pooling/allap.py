@@ -2,7 +2,6 @@
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 
 class AllAP(nn.Module):
     """ Implements the Average Pooling layer over all columns (all-ap) of a 
@@ -22,9 +21,7 @@ class AllAP(nn.Module):
                 out: torch.Tensor of shape (batch_size, height)
                     The output of the all-ap layer.
         """
-        pool_width = x.shape[2]
-        out = F.avg_pool2d(x, (pool_width, 1)) # shape (batch_size, 1, 1, height)
-        out = torch.squeeze(out, dim=2) # shape (batch_size, 1, height)
+        out = torch.mean(x, dim=2) # shape (batch_size, 1, height)
         out = torch.squeeze(out, dim=1) # shape (batch_size, height)
         return out
 
@@ -413,6 +413,11 @@ def setup_block(max_length, block_config):
     else:
         raise BlockTypeError
 
+    # Optionally compile the block to fuse its small ops and remove the 
+    # per-op Python dispatch overhead
+    if block_config.get("compile", False):
+        block = torch.compile(block)
+
     return block, output_size    
 
 
@@ -35,7 +35,7 @@ def loss_fn_factory(config):
     ignore_index = config.get("ignore_index", -100)
     pos_weight = config.get("pos_weight", None)
     reduce = config.get("reduce", None)
-    reduction = config.get("reduction", "elementwise_mean")
+    reduction = config.get("reduction", "mean")
     size_average = config.get("size_average", None)
     weight = config.get("weight", None)
     
@@ -64,7 +64,8 @@ def loss_fn_factory(config):
             weight=weight,
             size_average=size_average,
             ignore_index=ignore_index,
-            reduce=reduce
+            reduce=reduce,
+            reduction=reduction
         )
     elif config["type"] == "kullback-leibler divergence":
         return nn.KLDivLoss(
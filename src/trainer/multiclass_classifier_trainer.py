@@ -1,15 +1,13 @@
 # coding=utf-8
 
+import contextlib
 import copy
 import os
 import torch
-from collections import defaultdict
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import f1_score
-from sklearn.metrics import precision_score
-from sklearn.metrics import recall_score
+import numpy as np
 from string import Template
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 import trainer.utils
 
@@ -38,6 +36,29 @@ class MulticlassClassifierTrainer(object):
                     Controls how often to log training and validation results.
                 num_workers: int
                     Controls how many worker processes to use for training.
+                prefetch_factor: int
+                    Optional, the number of batches loaded in advance by each
+                    worker process. Defaults to 4.
+                mixed_precision: string
+                    Optional, the reduced precision dtype used for the forward
+                    pass. Should be "bfloat16", "float16", or None to train in
+                    full precision. Losses are scaled when using "float16" to
+                    prevent gradient underflow. Defaults to None.
+                reuse_pinned_buffers: bool
+                    Optional, specifies whether to collate batches into a 
+                    fixed ring of pinned memory buffers instead of pinning 
+                    each batch separately. Batches are then loaded in the main
+                    process, so num_workers is ignored. Only has an effect 
+                    when training on a GPU. Defaults to False.
+                use_cuda_graphs: bool
+                    Optional, specifies whether to capture the forward and 
+                    backward passes of a training step in a CUDA graph and 
+                    replay it for every batch. Incomplete final batches are
+                    dropped from the training set so every batch has the same
+                    shape. Every tensor created in the model's forward pass
+                    must be allocated on the GPU, since host to device 
+                    copies cannot be captured. Only has an effect when 
+                    training on a GPU. Defaults to False.
                 checkpoint_dir: string
                     Specifies the directory where checkpoint files and plots
                     will be saved.
@@ -51,6 +72,12 @@ class MulticlassClassifierTrainer(object):
                     GPUs, use "cuda:0" to train on the first GPU and "cuda:1"
                     to train on the second GPU.
 
+            If the default process group has been initialized (e.g. when
+            launched with torchrun), training is distributed across the
+            processes: the model should be wrapped in DistributedDataParallel,
+            each process trains on its own shard of the training set, and only
+            the first process logs progress and saves checkpoints.
+
             Args:
                 config: dict
                     The configuration to use for training and evaluation.
@@ -63,6 +90,12 @@ class MulticlassClassifierTrainer(object):
         self._model = None
         self._history = None
 
+        # Defaults for optional configuration attributes
+        self.prefetch_factor = 4
+        self.mixed_precision = None
+        self.reuse_pinned_buffers = False
+        self.use_cuda_graphs = False
+
         # Hacky way to get tqdm to work in the shell and in jupyter
         if config["environment"] == "script":
             from tqdm import tqdm
@@ -75,6 +108,10 @@ class MulticlassClassifierTrainer(object):
         for attr, val in config.items():
             setattr(self, attr, val)
 
+        # Only log from a single process during distributed training
+        if not trainer.utils.is_main_process():
+            self.verbose = False
+
     def train(self, 
               loss_fn,
               model,
@@ -94,7 +131,8 @@ class MulticlassClassifierTrainer(object):
 
             Args:
                 loss_fn: nn.Loss
-                    The loss function to use for training.
+                    The loss function to use for training. The loss should be
+                    averaged over each batch (i.e. reduction="mean").
                 model: nn.Module
                     The model to train.
                 optim: optim.Optimizer
@@ -112,26 +150,46 @@ class MulticlassClassifierTrainer(object):
             Returns:
                 None
         """
+        if self._use_cuda_graphs() and trainer.utils.is_distributed():
+            raise ValueError("CUDA graphs are not supported for distributed training.")
+
         # Setup
         self._loss_fn = loss_fn
         self._model = model
-        self._best_model = copy.deepcopy(model)
+        self._best_model = copy.deepcopy(trainer.utils.unwrap_model(model))
         self._optimizer = optimizer
         self._scheduler = scheduler
+        self._scaler = self._make_grad_scaler()
+        self._graph = None
+
+        # Create the data loaders once so worker processes persist across epochs
+        train_loader = \
+            self._make_dataloader(
+                trainset, 
+                shuffle=True, 
+                drop_last=self._use_cuda_graphs(),
+                distributed=trainer.utils.is_distributed()
+            )
+        val_loader = self._make_dataloader(valset, shuffle=False) if valset else None
 
         # Training loop
         self._best_f1 = 0
-        self._history = defaultdict(list)
-        for epoch in trange(self.num_epochs, desc="epochs", position=0):
+        self._history = {}
+        show_progress = trainer.utils.is_main_process()
+        for epoch in trange(self.num_epochs, desc="epochs", position=0, disable=not show_progress):
+
+            # Reshuffle the shards of the training set
+            if isinstance(train_loader.sampler, DistributedSampler):
+                train_loader.sampler.set_epoch(epoch)
 
             # Process training set
-            train_results, _ = self._process(trainset, False, True, desc="train")
+            train_results, _ = self._process(train_loader, False, True, desc="train")
             if self.verbose:
                 tqdm.write(PROGRESS_MSG.substitute(train_results))
 
             # Process validation set, if provided
             if valset:
-                val_results, _ = self._process(valset, False, False, desc="val")
+                val_results, _ = self._process(val_loader, False, False, desc="val")
                 if self.verbose:
                     tqdm.write(PROGRESS_MSG.substitute(val_results))
 
@@ -140,11 +198,9 @@ class MulticlassClassifierTrainer(object):
                 self._scheduler.step()
 
             # Update run history
-            for name, val in train_results.items():
-                self._history["train_{}".format(name)].append(val)
-            if val_results:
-                for name, val in val_results.items():
-                    self._history["val_{}".format(name)].append(val)
+            self._update_history("train", train_results, epoch)
+            if valset:
+                self._update_history("val", val_results, epoch)
 
             # Update best model
             if valset:
@@ -159,7 +215,7 @@ class MulticlassClassifierTrainer(object):
                 filename = "checkpoint_epoch_{}".format(epoch)
                 filepath = os.path.join(self.checkpoint_dir, filename)
                 self._save_checkpoint(filepath)
-                # self._save_plots()
+                # self._save_plots(epoch)
 
     def predict(self, dataset):
         """ Processes the examples in the dataset for evaluation and
@@ -176,18 +232,93 @@ class MulticlassClassifierTrainer(object):
                 predicted: list of int
                     Contains the predictions of the examples in the dataset.
         """
-        return self._process(dataset, True, False, desc="predicting")
+        dataloader = self._make_dataloader(dataset, shuffle=False)
+        return self._process(dataloader, True, False, desc="predicting")
+
+    def _make_dataloader(self, 
+                         dataset, 
+                         shuffle, 
+                         drop_last=False, 
+                         distributed=False):
+        """ Creates a DataLoader for iterating over the examples in the 
+            dataset.
+
+            Worker processes are kept alive between passes over the dataset,
+            so the DataLoader should be reused across epochs. If pinned 
+            buffers are reused, batches are instead collated in the main 
+            process into a ring of pinned buffers.
+
+            Args:
+                dataset: Dataset
+                    Contains the examples and their labels.
+                shuffle: bool
+                    Specifies whether to reshuffle the examples every epoch.
+                    Only the training set should be shuffled, so that 
+                    evaluation reads examples sequentially and predictions
+                    are returned in dataset order.
+                drop_last: bool
+                    Optional, specifies whether to drop the final batch if it
+                    is smaller than the batch size.
+                distributed: bool
+                    Optional, specifies whether each process should only load
+                    its own shard of the dataset.
+
+            Returns:
+                dataloader: DataLoader
+                    Loads batches of examples from the dataset.
+        """
+        use_cuda = trainer.utils.uses_cuda(self.device)
+
+        # The sampler shuffles and drops examples for distributed loading
+        sampler = None
+        if distributed:
+            sampler = \
+                DistributedSampler(
+                    dataset, 
+                    shuffle=shuffle, 
+                    drop_last=drop_last
+                )
+            shuffle = False
+
+        if self.reuse_pinned_buffers and use_cuda:
+            return \
+                DataLoader(
+                    dataset,
+                    batch_size=self.batch_size,
+                    shuffle=shuffle,
+                    drop_last=drop_last,
+                    sampler=sampler,
+                    collate_fn=trainer.utils.PinnedRingCollator(self.prefetch_factor + 1)
+                )
+
+        # Worker options are only valid when using worker processes
+        worker_kwargs = {}
+        if self.num_workers > 0:
+            worker_kwargs["persistent_workers"] = True
+            worker_kwargs["prefetch_factor"] = self.prefetch_factor
+
+        return \
+            DataLoader(
+                dataset,
+                batch_size=self.batch_size,
+                shuffle=shuffle,
+                drop_last=drop_last,
+                sampler=sampler,
+                num_workers=self.num_workers,
+                pin_memory=use_cuda,
+                **worker_kwargs
+            )
 
     def _process(self, 
-                 dataset, 
+                 dataloader, 
                  use_best,
                  is_training,
                  desc=None):
         """ Processes the examples in the dataset.
 
             Args:
-                dataset: Dataset
-                    Contains the examples and their labels.
+                dataloader: DataLoader
+                    Loads batches of examples and their labels.
                 use_best: bool 
                     Specifies whether to use the current or best model
                     for processing examples. The best model should be used
@@ -209,49 +340,84 @@ class MulticlassClassifierTrainer(object):
                 preds: list of int
                     Contains the predictions of the examples in the dataset.
         """
-        # Get the appropriate model for processing
+        # Get the appropriate model for processing. Evaluation runs on the
+        # full dataset in every process, so distributed models are unwrapped.
         model = self._best_model if use_best else self._model
+        if not is_training:
+            model = trainer.utils.unwrap_model(model)
         model = model.train() if is_training else model.eval()
 
         # Process batches
-        actual = []
+        confusion = None
         predicted = []
         total_loss = 0
-        dataloader = \
-            DataLoader(
-                dataset,
-                batch_size=self.batch_size,
-                num_workers=self.num_workers
-            )
-        for features, labels in tqdm(dataloader, desc=desc, position=1):
+        show_progress = trainer.utils.is_main_process()
+        for features, labels in tqdm(dataloader, desc=desc, position=1, disable=not show_progress):
             
             # Load tensors to correct device
-            features, labels = self._move_to_device(features, labels)
+            features, labels = \
+                self._move_to_device(features, labels, non_blocking=True)
+            if isinstance(dataloader.collate_fn, trainer.utils.PinnedRingCollator):
+                dataloader.collate_fn.record()
+
+            # Forward and backward pass
+            if is_training and self._use_cuda_graphs():
+                scores, batch_loss = self._replay_graph(features, labels)
+            else:
+                # Skip autograd bookkeeping entirely when not training
+                with torch.inference_mode(not is_training), self._autocast():
+                    scores = model(features)
+                    batch_loss = self._loss_fn(scores, labels)
+                if is_training:
+                    self._optimizer.zero_grad(set_to_none=True)
+                    self._scaler.scale(batch_loss).backward()
+
+            # A single comparison is cheaper than a reduction for two classes
+            if scores.shape[1] == 2:
+                preds = (scores[:, 1] > scores[:, 0]).long()
+            else:
+                preds = scores.argmax(1)
+
+            # Update the confusion matrix and store predicted labels on the 
+            # device to avoid synchronizing with the host every batch
+            if confusion is None:
+                num_classes = scores.shape[1]
+                confusion = \
+                    torch.zeros(
+                        num_classes, 
+                        num_classes, 
+                        dtype=torch.long, 
+                        device=labels.device
+                    )
+            confusion.index_put_(
+                (labels, preds), 
+                torch.ones_like(labels), 
+                accumulate=True
+            )
+            predicted.append(preds.detach())
 
-            # Forward pass
-            scores = self._model(features)
-            preds = torch.argmax(scores, dim=1)
+            # Update loss on the device, detached so the graph can be freed.
+            # The batch loss is a mean, so weight it by the batch size.
+            total_loss += batch_loss.detach() * labels.size(0)
 
-            # Store actual and predicted labels
-            actual.extend(labels.cpu().tolist())
-            predicted.extend(preds.cpu().tolist())
+            # Update model weights
+            if is_training:
+                self._scaler.step(self._optimizer)
+                self._scaler.update()
 
-            # Update loss
-            batch_loss = torch.sum(self._loss_fn(scores, labels))
-            total_loss += batch_loss
+        # Combine the results of every shard of a distributed training set
+        if is_training and trainer.utils.is_distributed():
+            torch.distributed.all_reduce(confusion)
+            torch.distributed.all_reduce(total_loss)
 
-            # Backward pass
-            if is_training:
-                self._optimizer.zero_grad()
-                batch_loss.backward()
-                self._optimizer.step()
+        # Copy results to the host once all batches are processed
+        total_loss = float(total_loss)
+        confusion = confusion.cpu().numpy()
+        predicted = torch.cat(predicted).cpu().numpy()
 
         # Compute evaluation metrics
-        avg_loss = total_loss / len(dataset)
-        accuracy = accuracy_score(actual, predicted)
-        precision = precision_score(actual, predicted, average="macro")
-        recall = recall_score(actual, predicted, average="macro")
-        f1 = f1_score(actual, predicted, average="macro")
+        avg_loss = total_loss / int(confusion.sum())
+        accuracy, precision, recall, f1 = trainer.utils.compute_metrics(confusion)
 
         # Return results
         results = {
@@ -262,9 +428,129 @@ class MulticlassClassifierTrainer(object):
             "recall": recall,
             "f1": f1
         }
-        return results, predicted
+        return results, predicted.tolist()
+
+    def _autocast(self):
+        """ Creates the context manager used to run the forward pass in
+            mixed precision.
 
-    def _move_to_device(self, *tensors):
+            Args:
+                None
+
+            Returns:
+                context: torch.autocast or contextlib.nullcontext
+                    The autocast context manager. If mixed precision is not
+                    configured, this is a no-op context manager.
+        """
+        if self.mixed_precision is None:
+            return contextlib.nullcontext()
+        device_type = "cuda" if trainer.utils.uses_cuda(self.device) else "cpu"
+        return torch.autocast(
+            device_type, 
+            dtype=getattr(torch, self.mixed_precision),
+            cache_enabled=not self._use_cuda_graphs() # required for graph capture
+        )
+
+    def _make_grad_scaler(self):
+        """ Creates the gradient scaler used to prevent float16 gradients 
+            from underflowing.
+
+            The scaler is disabled, and passes losses and optimizer steps
+            through unchanged, unless training with float16 on a GPU.
+
+            Args:
+                None
+
+            Returns:
+                scaler: torch.amp.GradScaler
+                    The gradient scaler.
+        """
+        enabled = self.mixed_precision == "float16" and \
+            trainer.utils.uses_cuda(self.device)
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+
+    def _use_cuda_graphs(self):
+        """ Determines whether training steps are replayed from a CUDA graph.
+
+            Args:
+                None
+
+            Returns:
+                use_cuda_graphs: bool
+                    True if CUDA graphs are configured and training on a GPU.
+        """
+        return self.use_cuda_graphs and trainer.utils.uses_cuda(self.device)
+
+    def _capture_graph(self, features, labels):
+        """ Captures the forward and backward passes of a training step in a
+            CUDA graph.
+
+            The optimizer step is not captured so that changes to the 
+            learning rate made by the scheduler still take effect. The 
+            gradients are written to static memory by every replay, so they
+            must not be reset between training steps.
+
+            Args:
+                features: torch.Tensor
+                    A batch of examples with the shape used for every replay.
+                labels: torch.Tensor
+                    The labels of the examples.
+
+            Returns:
+                None
+        """
+        self._static_features = features.clone()
+        self._static_labels = labels.clone()
+
+        # Warm up on a side stream before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._optimizer.zero_grad(set_to_none=True)
+                with self._autocast():
+                    scores = self._model(self._static_features)
+                    loss = self._loss_fn(scores, self._static_labels)
+                self._scaler.scale(loss).backward()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # Capture the training step, allocating the gradients in the graph
+        self._graph = torch.cuda.CUDAGraph()
+        self._optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(self._graph):
+            with self._autocast():
+                self._static_scores = self._model(self._static_features)
+                self._static_loss = \
+                    self._loss_fn(self._static_scores, self._static_labels)
+            self._scaler.scale(self._static_loss).backward()
+
+    def _replay_graph(self, features, labels):
+        """ Runs the forward and backward passes for a batch of training 
+            examples by replaying the captured CUDA graph. The graph is 
+            captured on the first call.
+
+            Args:
+                features: torch.Tensor
+                    A batch of examples.
+                labels: torch.Tensor
+                    The labels of the examples.
+
+            Returns:
+                scores: torch.Tensor
+                    The scores for each class for each example. This tensor
+                    is overwritten by the next replay.
+                loss: torch.Tensor
+                    The loss for the batch. This tensor is overwritten by
+                    the next replay.
+        """
+        if self._graph is None:
+            self._capture_graph(features, labels)
+        self._static_features.copy_(features, non_blocking=True)
+        self._static_labels.copy_(labels, non_blocking=True)
+        self._graph.replay()
+        return self._static_scores, self._static_loss
+
+    def _move_to_device(self, *tensors, non_blocking=False):
         """ Moves the given modules / tensors to the appropriate device.
 
             If a device was specified in the training configuration, then
@@ -276,12 +562,44 @@ class MulticlassClassifierTrainer(object):
             Args:
                 tensors: list of tensors / modules
                     Contains the tensors / modules we would like to move.
+                non_blocking: bool
+                    Optional, specifies whether host to device copies should
+                    be asynchronous.
 
             Returns:
                 tensors: list of tensors / modules
                     Contains the tensors / modules moved to the proper device.
         """
-        return trainer.utils.move_to_device(self.device, *tensors)
+        return trainer.utils.move_to_device(
+            self.device, 
+            *tensors, 
+            non_blocking=non_blocking
+        )
+
+    def _update_history(self, prefix, results, epoch):
+        """ Records the results from the current epoch in the run history.
+
+            Each metric's history is stored in an array with an entry for 
+            every epoch, allocated the first time the metric is recorded. 
+            Entries for epochs that have not run yet are NaN.
+
+            Args:
+                prefix: string
+                    The name of the dataset the results were computed on.
+                results: dict
+                    Contains the results of performance metrics from the
+                    current epoch.
+                epoch: int
+                    The current epoch number.
+
+            Returns:
+                None
+        """
+        for name, val in results.items():
+            key = "{}_{}".format(prefix, name)
+            if key not in self._history:
+                self._history[key] = np.full(self.num_epochs, np.nan, dtype=np.float32)
+            self._history[key][epoch] = val
 
     def _update_best_model(self, results):
         """ Helper function to update the best model observed.
@@ -297,19 +615,20 @@ class MulticlassClassifierTrainer(object):
         if results["f1"] > self._best_f1:
             if self.verbose:
                 tqdm.write("New best checkpoint!")
-            self._best_model = copy.deepcopy(self._model)
+            self._best_model = copy.deepcopy(trainer.utils.unwrap_model(self._model))
             self._best_f1 = results["f1"]
             filepath = os.path.join(self.checkpoint_dir, "best_checkpoint")
             self._save_checkpoint(filepath)
 
     def _save_checkpoint(self, filepath):
-        """ Saves a checkpoint of the model at the given filepath.
+        """ Saves a checkpoint of the model at the given filepath. During
+            distributed training, only the first process saves checkpoints.
 
             The checkpoint saves the following information to a file:
 
                 - the current state of the model
                  the current state of the optimizer
-                - the current history of the model
+                - the current history of the model, as lists of floats
             
             Args:
                 filepath: string
@@ -318,25 +637,30 @@ class MulticlassClassifierTrainer(object):
             Returns:
                 None
         """
+        if not trainer.utils.is_main_process():
+            return
         trainer.utils.save_checkpoint(
-            self._model, 
+            trainer.utils.unwrap_model(self._model), 
             self._optimizer, 
-            self._history, 
+            {name: vals.tolist() for name, vals in self._history.items()}, 
             filepath
         )
 
-    def _save_plots(self):
+    def _save_plots(self, epoch):
         """ Saves plots of the model's metric history.
 
             The plots will be saved to the checkpoint directory.
 
             Args:
-                None
+                epoch: int
+                    The current epoch number. Only the history up to and 
+                    including this epoch is plotted.
 
             Returns:
                 None
         """
-        trainer.utils.generate_plots(
-            self._history, 
-            self.checkpoint_dir
-        )
+        history = {
+            name: vals[:epoch + 1]
+            for name, vals in self._history.items()
+        }
+        trainer.utils.generate_plots(history, self.checkpoint_dir)
@@ -3,11 +3,13 @@
 import copy
 import os
 import torch
+import torch.distributed as dist
 import numpy as np
 import matplotlib.pyplot as plt
+from torch.nn.parallel import DistributedDataParallel
 plt.switch_backend("agg")  
 
-def move_to_device(device, *tensors):
+def move_to_device(device, *tensors, non_blocking=False):
     """ Moves the given modules / tensors to the appropriate device.
 
         If a device was specified in the training configuration, then
@@ -19,6 +21,10 @@ def move_to_device(device, *tensors):
         Args:
             tensors: list of tensors / modules
                 Contains the tensors / modules we would like to move.
+            non_blocking: bool
+                Optional, specifies whether host to device copies should be
+                asynchronous. This only has an effect for tensors stored in
+                pinned memory.
                
         Returns:
             tensors: list of tensors / modules
@@ -27,17 +33,185 @@ def move_to_device(device, *tensors):
                 is returned.
     """
     if device:
-        if "cuda" in device:
-            torch.cuda.empty_cache()
-        tensors = list(map(lambda t: t.to(device=device), tensors))
+        tensors = list(map(lambda t: t.to(device=device, non_blocking=non_blocking), tensors))
     elif torch.cuda.is_available():
-        torch.cuda.empty_cache()
-        tensors = list(map(lambda t: t.cuda(), tensors))
+        tensors = list(map(lambda t: t.to(device="cuda", non_blocking=non_blocking), tensors))
     else:
         tensors = list(map(lambda t: t.cpu(), tensors))
 
     return tensors[0] if len(tensors) == 1 else tensors
 
+def uses_cuda(device):
+    """ Determines whether tensors will be moved to a GPU by move_to_device.
+
+        Args:
+            device: string
+                The device specified in the training configuration.
+
+        Returns:
+            uses_cuda: bool
+                True if tensors will be stored on a GPU, False otherwise.
+    """
+    if device:
+        return "cuda" in device
+    return torch.cuda.is_available()
+
+def is_distributed():
+    """ Determines whether the default process group for distributed training
+        has been initialized.
+
+        Args:
+            None
+
+        Returns:
+            is_distributed: bool
+                True if training is distributed across processes.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+def is_main_process():
+    """ Determines whether this is the first process of a distributed training
+        run. Processes that are not part of a distributed run are always the
+        main process.
+
+        Args:
+            None
+
+        Returns:
+            is_main_process: bool
+                True if this process should log results and save checkpoints.
+    """
+    return not is_distributed() or dist.get_rank() == 0
+
+def unwrap_model(model):
+    """ Retrieves the model wrapped by DistributedDataParallel.
+
+        Args:
+            model: torch.nn.Module
+                The model, which may be wrapped by DistributedDataParallel.
+
+        Returns:
+            model: torch.nn.Module
+                The wrapped model, or the given model if it is not wrapped.
+    """
+    if isinstance(model, DistributedDataParallel):
+        return model.module
+    return model
+
+def compute_metrics(confusion):
+    """ Computes the accuracy and the macro-level precision, recall, and f1
+        scores from a confusion matrix.
+
+        As in sklearn, classes that appear in neither the actual nor the 
+        predicted labels are left out of the macro-level averages, and 
+        scores with a zero denominator are set to 0.
+
+        Args:
+            confusion: np.ndarray of shape (num_classes, num_classes)
+                Entry (i, j) counts the examples with label i that were
+                predicted to be in class j.
+
+        Returns:
+            accuracy: float
+                The fraction of examples classified correctly.
+            precision: float
+                The macro-level precision.
+            recall: float
+                The macro-level recall.
+            f1: float
+                The macro-level f1 score.
+    """
+    true_positives = np.diag(confusion).astype(np.float64)
+    actual_counts = confusion.sum(axis=1)
+    predicted_counts = confusion.sum(axis=0)
+    present = (actual_counts + predicted_counts) > 0
+
+    def safe_divide(a, b):
+        return np.divide(a, b, out=np.zeros_like(true_positives), where=b > 0)
+
+    precisions = safe_divide(true_positives, predicted_counts)
+    recalls = safe_divide(true_positives, actual_counts)
+    f1s = safe_divide(2 * precisions * recalls, precisions + recalls)
+
+    accuracy = true_positives.sum() / confusion.sum()
+    precision = precisions[present].mean()
+    recall = recalls[present].mean()
+    f1 = f1s[present].mean()
+    return float(accuracy), float(precision), float(recall), float(f1)
+
+
+class PinnedRingCollator(object):
+    """ Collates batches of examples into a ring of reusable pinned memory
+        buffers, avoiding a pinned memory allocation for every batch.
+
+        The buffers are allocated on the first call using the shapes of the
+        first batch, so every batch must have the same shape (the final batch
+        may be smaller). Collation must happen in the main process, since 
+        batches returned by worker processes are moved to shared memory.
+    """
+
+    def __init__(self, num_buffers):
+        """ Initializes the PinnedRingCollator.
+
+            Args:
+                num_buffers: int
+                    The number of pinned buffers in the ring.
+
+            Returns:
+                None
+        """
+        self.num_buffers = num_buffers
+        self._buffers = None
+        self._events = [None] * num_buffers
+        self._index = -1
+
+    def __call__(self, batch):
+        """ Stacks the examples in the batch into the next pinned buffer.
+
+            Args:
+                batch: list of tuples of tensors
+                    Contains the examples in the batch.
+
+            Returns:
+                tensors: list of tensors
+                    Contains the stacked fields of the examples, stored in
+                    pinned memory.
+        """
+        self._index = (self._index + 1) % self.num_buffers
+        if self._buffers is None:
+            self._buffers = [
+                [
+                    torch.empty((len(batch),) + t.shape, dtype=t.dtype, pin_memory=True)
+                    for t in batch[0]
+                ]
+                for _ in range(self.num_buffers)
+            ]
+
+        # Wait for the last copy out of this buffer before overwriting it
+        if self._events[self._index] is not None:
+            self._events[self._index].synchronize()
+
+        buffers = self._buffers[self._index]
+        return [
+            torch.stack(field, out=buffer[:len(batch)])
+            for field, buffer in zip(zip(*batch), buffers)
+        ]
+
+    def record(self):
+        """ Marks the most recently collated batch as queued for copying to
+            the GPU. Its buffer will not be reused until the copy completes.
+
+            Args:
+                None
+
+            Returns:
+                None
+        """
+        event = torch.cuda.Event()
+        event.record()
+        self._events[self._index] = event
+
+
 def save_checkpoint(model, optimizer, history, filepath):
     """ Saves the state of the model to a pickle file so that it can continue 
         to be trained at a later time.
@@ -88,7 +262,9 @@ def load_checkpoint(filepath, map_location=None):
             epoch: int
                 The current epoch number.
     """
-    state = torch.load(filepath, map_location)
+    # Checkpoints are trusted local files that also pickle the run history,
+    # so they cannot be loaded with torch.load's weights_only default
+    state = torch.load(filepath, map_location, weights_only=False)
     return state
     
 
@@ -96,7 +272,7 @@ def generate_plots(history, checkpoint_dir):
     """ Creates plots of the metric values stored in history.
     
         Args:
-            history: defaultdict
+            history: dict of string to np.ndarray
                 Contains histories of desired run metrics.
             checkpoint_dir: string
                 Where to save the plots
@@ -117,7 +117,9 @@ def load_checkpoint(filename, map_location=None):
             epoch: int
                 The current epoch number.
     """
-    state = torch.load(filename, map_location)
+    # Checkpoints are trusted local files that also pickle the run history,
+    # so they cannot be loaded with torch.load's weights_only default
+    state = torch.load(filename, map_location, weights_only=False)
     return state
     
 